@@ -1,11 +1,28 @@
+import io
+import mmap
 import os
-from glob import glob
+from collections import OrderedDict
 from logging import getLogger
-
-from b2py import utils as b2_utils
+from threading import Lock
+from typing import BinaryIO
 
 logger = getLogger('cache')
 
+# Size of the buffer used when copying file contents to disk
+CHUNK_SIZE = 1 << 20
+
+# Maximum number of cached files to keep memory mapped at once
+MAX_MMAPS = 64
+
+# Maximum number of cached files to keep open for writing at once
+MAX_OPEN_FDS = 64
+
+# Suffix of files that are still being written, before they replace the entry
+TEMP_SUFFIX = '.tmp'
+
+# Prefix of files in the cache dir that are not cache entries
+HIDDEN_PREFIX = '.'
+
 
 class Cache:
   """Cache files to the local disk to save bandwidth."""
@@ -19,16 +36,39 @@ class Cache:
     """
     self.cache_dir = cache_dir
     self.cache_size = int(cache_size * 1e6)
-    self.index = {}
-    self.touch_list = []
+    # Map from file id to size, ordered from least to most recently used
+    self.index = OrderedDict()
+    # Running total of the sizes in the index
+    self._used_bytes = 0
+    # Map from file id to a read only mapping of the file, used for reads
+    self._mmaps = OrderedDict()
+    self._mmap_lock = Lock()
+    # Map from file id to a descriptor opened for writing, used for updates
+    self._fds = OrderedDict()
+    self._fd_lock = Lock()
     self._populate_index()
 
   def _populate_index(self):
     """Read the cache dir and set a local index of records."""
     os.makedirs(self.cache_dir, exist_ok=True)
-    local_files = glob('{}/*'.format(self.cache_dir))
-    for file in local_files:
-      self._add_to_index(os.path.basename(file), os.path.getsize(file))
+    stats = []
+    with os.scandir(self.cache_dir) as entries:
+      for entry in entries:
+        if (not entry.is_file(follow_symlinks=False) or
+            entry.name.startswith(HIDDEN_PREFIX)):
+          continue
+        if entry.name.endswith(TEMP_SUFFIX):
+          # Left over from a write that never finished
+          os.remove(entry.path)
+          continue
+        stats.append((entry.name, entry.stat(follow_symlinks=False)))
+
+    # Insert oldest first so the least recently written files are evicted first
+    stats.sort(key=lambda name_stat: name_stat[1].st_mtime)
+    for name, stat in stats:
+      self.index[name] = stat.st_size
+      self._used_bytes += stat.st_size
+    self._recover_disk_space()
 
   def _touch_file(self, file_id):
     """Move the file to the end of the queue by touching it.
@@ -36,20 +76,50 @@ class Cache:
     Args:
       file_id: The file to touch.
     """
-    if file_id in self.touch_list:
-      self.touch_list.remove(file_id)
-    self.touch_list.append(file_id)
+    self.index.move_to_end(file_id)
 
   def _recover_disk_space(self):
     """Make sure we stay under our disk space quota."""
     while self.used_disk_space > self.cache_size:
       space_to_recover = self.used_disk_space - self.cache_size
       logger.info('Recovering disk space %s', space_to_recover)
-      lru_file = self.touch_list.pop(0)
+      lru_file, lru_size = self.index.popitem(last=False)
+      self._used_bytes -= lru_size
+      self._close_handles(lru_file)
       file_path = self._path_to_file(lru_file)
       logger.info('Deleting %s', file_path)
       os.remove(file_path)
-      del self.index[lru_file]
+
+  def _close_mmap(self, file_id: str):
+    """Close the memory mapping of a file if it is open.
+
+    Args:
+      file_id: The file to unmap.
+    """
+    with self._mmap_lock:
+      mm = self._mmaps.pop(file_id, None)
+      if mm is not None:
+        mm.close()
+
+  def _close_fd(self, file_id: str):
+    """Close the write descriptor of a file if it is open.
+
+    Args:
+      file_id: The file to close.
+    """
+    with self._fd_lock:
+      fd = self._fds.pop(file_id, None)
+      if fd is not None:
+        os.close(fd)
+
+  def _close_handles(self, file_id: str):
+    """Close any open mapping or descriptor of a file.
+
+    Args:
+      file_id: The file to close.
+    """
+    self._close_mmap(file_id)
+    self._close_fd(file_id)
 
   def _path_to_file(self, file_id: str):
     """
@@ -67,7 +137,7 @@ class Cache:
     Returns:
       The used disk space in bytes.
     """
-    return sum(self.index.values())
+    return self._used_bytes
 
   def _add_to_index(self, file_id: str, content_size: int):
     """
@@ -75,8 +145,9 @@ class Cache:
       file_id: The file key.
       content_size: The size of the file's contents.
     """
-    self._touch_file(file_id)
+    self._used_bytes += content_size - self.index.get(file_id, 0)
     self.index[file_id] = content_size
+    self._touch_file(file_id)
     self._recover_disk_space()
 
   def has(self, file_id):
@@ -96,9 +167,37 @@ class Cache:
       file_id: The unique key to look the file up by.
       contents: The file contents.
     """
+    self.add_stream(file_id, io.BytesIO(contents))
+
+  def add_stream(self, file_id: str, reader: BinaryIO):
+    """Add a file to the cache, copying from a file-like object.
+
+    The contents are copied to disk in fixed size chunks, so the whole file
+    never needs to be held in memory. They are written to a temporary file
+    that is renamed over the entry once complete, so a crash never leaves a
+    partially written file in the cache.
+
+    Args:
+      file_id: The unique key to look the file up by.
+      reader: A binary file-like object to read the contents from.
+    """
+    self._close_handles(file_id)
     file_path = self._path_to_file(file_id)
-    b2_utils.write_file(file_path, contents)
-    self._add_to_index(file_id, len(contents))
+    temp_path = file_path + TEMP_SUFFIX
+    written = 0
+    try:
+      with open(temp_path, 'wb', buffering=CHUNK_SIZE) as f:
+        while True:
+          chunk = reader.read(CHUNK_SIZE)
+          if not chunk:
+            break
+          written += f.write(chunk)
+      os.replace(temp_path, file_path)
+    except BaseException:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise
+    self._add_to_index(file_id, written)
 
   def update(self, file_id: str, data: bytes, offset: int) -> int:
     """Update an existing file in the cache.
@@ -115,11 +214,73 @@ class Cache:
       raise KeyError('No file {}'.format(file_id))
 
     self._touch_file(file_id)
-    file_path = self._path_to_file(file_id)
 
-    with open(file_path, 'r+b') as f:
-      f.seek(offset)
-      return f.write(data)
+    with self._fd_lock:
+      fd = self._open_fd(file_id)
+      num_bytes = os.pwrite(fd, data, offset)
+      file_size = os.fstat(fd).st_size
+
+    self._resize(file_id, file_size)
+    return num_bytes
+
+  def truncate(self, file_id: str, length: int):
+    """Truncate or zero pad an existing file in the cache.
+
+    Args:
+      file_id: The file to truncate.
+      length: The new length of the file.
+    """
+    if not self.has(file_id):
+      raise KeyError('No file {}'.format(file_id))
+
+    self._touch_file(file_id)
+
+    # Reads of a mapping past the new end of the file would fault, so unmap it
+    # first and keep new mappings out until the file has its new length
+    with self._mmap_lock:
+      mm = self._mmaps.pop(file_id, None)
+      if mm is not None:
+        mm.close()
+      with self._fd_lock:
+        os.ftruncate(self._open_fd(file_id), length)
+
+    self._resize(file_id, length)
+
+  def _open_fd(self, file_id: str) -> int:
+    """Get a descriptor for writing to a cached file.
+
+    The caller must hold the descriptor lock.
+
+    Args:
+      file_id: The file to open.
+
+    Returns:
+      The open file descriptor.
+    """
+    fd = self._fds.get(file_id)
+    if fd is None:
+      fd = os.open(self._path_to_file(file_id), os.O_RDWR)
+      self._fds[file_id] = fd
+      if len(self._fds) > MAX_OPEN_FDS:
+        _, lru_fd = self._fds.popitem(last=False)
+        os.close(lru_fd)
+    else:
+      self._fds.move_to_end(file_id)
+    return fd
+
+  def _resize(self, file_id: str, file_size: int):
+    """Record the new size of a cached file after it was written to.
+
+    Args:
+      file_id: The file that changed.
+      file_size: The new size of the file.
+    """
+    # Shared mappings see the new bytes, but not a change in length
+    if file_size != self.index[file_id]:
+      self._close_mmap(file_id)
+
+    self._used_bytes += file_size - self.index[file_id]
+    self.index[file_id] = file_size
 
   def get(self, file_id: str, offset: int = 0, size: int = None) -> bytes:
     """
@@ -135,11 +296,81 @@ class Cache:
       raise KeyError('No file {}'.format(file_id))
 
     self._touch_file(file_id)
-    file_path = self._path_to_file(file_id)
+    if self.index[file_id] == 0:
+      # Empty files cannot be memory mapped
+      return b''
+
+    end = None if size is None else offset + size
+    with self._mmap_lock:
+      mm = self._mmaps.get(file_id)
+      if mm is None:
+        fd = os.open(self._path_to_file(file_id), os.O_RDONLY)
+        try:
+          mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+          os.close(fd)
+        self._mmaps[file_id] = mm
+        if len(self._mmaps) > MAX_MMAPS:
+          _, lru_mm = self._mmaps.popitem(last=False)
+          lru_mm.close()
+      else:
+        self._mmaps.move_to_end(file_id)
+      return mm[offset:end]
 
-    with open(file_path, 'rb') as f:
-      f.seek(offset)
-      return f.read(size)
+  def send_to_fd(self,
+                 file_id: str,
+                 out_fd: int,
+                 offset: int = 0,
+                 size: int = None) -> int:
+    """Copy a cached file to another file descriptor inside the kernel.
+
+    Args:
+      file_id: The file to send.
+      out_fd: The file descriptor to write to, e.g. a socket or pipe.
+      offset: The offset in the file to start sending from.
+      size: The number of bytes to send, defaults to the rest of the file.
+
+    Returns:
+      The number of bytes sent.
+    """
+    if not self.has(file_id):
+      raise KeyError('No file {}'.format(file_id))
+
+    self._touch_file(file_id)
+    if size is None:
+      size = max(0, self.index[file_id] - offset)
+
+    fd = os.open(self._path_to_file(file_id), os.O_RDONLY)
+    try:
+      sent = 0
+      while sent < size:
+        num_bytes = os.sendfile(out_fd, fd, offset + sent, size - sent)
+        if num_bytes == 0:
+          break
+        sent += num_bytes
+      return sent
+    finally:
+      os.close(fd)
+
+  def rename(self, file_id: str, new_file_id: str):
+    """Move a cached file to a new key, without copying its contents.
+
+    Does nothing if the file is not cached. The entry becomes the most
+    recently used one.
+
+    Args:
+      file_id: The current key of the file.
+      new_file_id: The key to move the file to.
+    """
+    if not self.has(file_id):
+      return
+
+    self._close_handles(file_id)
+    self._close_handles(new_file_id)
+    os.replace(self._path_to_file(file_id), self._path_to_file(new_file_id))
+    content_size = self.index.pop(file_id)
+    self._used_bytes -= content_size
+    self._add_to_index(new_file_id, content_size)
 
   def delete(self, file_id: str):
     """Delete the file from the cache.
@@ -147,9 +378,10 @@ class Cache:
     Args:
       file_id: The file to delete.
     """
+    self._close_handles(file_id)
     file_path = self._path_to_file(file_id)
     os.remove(file_path)
-    del self.index[file_id]
+    self._used_bytes -= self.index.pop(file_id)
 
   def file_size(self, file_id: int):
     """Get the size of the file in bytes.
@@ -160,5 +392,4 @@ class Cache:
     Returns:
       The file size.
     """
-    file_path = self._path_to_file(file_id)
-    return os.path.getsize(file_path)
+    return self.index[file_id]
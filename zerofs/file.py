@@ -1,50 +1,127 @@
+import pickle
 from abc import ABC, abstractmethod
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from stat import S_IFDIR, S_IFREG
+from sys import intern
 from time import time
-from typing import Dict, List, Union
-from uuid import UUID, uuid4
+from types import MappingProxyType
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+from uuid import uuid4
 
 from b2py import B2
 
+# Shared by every node without extended attributes, which is nearly all of them
+_NO_ATTRS = MappingProxyType({})
+
+
+@lru_cache(maxsize=4096)
+def _split_path(path: str) -> Tuple[str, ...]:
+  """Split a path string into its components.
+
+  FUSE looks up the same paths many times in a row, so the results are cached.
+  The components are interned, like the keys of Directory.files.
+
+  Args:
+    path: The path to split.
+
+  Returns:
+    A tuple of the path components.
+  """
+  return tuple(intern(name) for name in path.strip('/').split('/'))
+
 
 class FileBase(ABC):
   """Abstract base class for file-like objects."""
 
+  # Trees can hold many nodes, so avoid a per-instance __dict__
+  __slots__ = ('name', 'st_mode', 'st_uid', 'st_gid', 'attrs', '_parent',
+               '_metadata')
+
+  # Whether the node is a directory, checked instead of comparing types
+  is_dir = False
+
   def __init__(self, name: str):
     self.name = name
     self.st_mode = None
     self.st_uid = None
     self.st_gid = None
-    self.attrs = {}
+    self.attrs = _NO_ATTRS
+    # The directory containing this node, set when it is added to one
+    self._parent = None
+    # The metadata dict handed to FUSE, rebuilt after the node changes
+    self._metadata = None
 
   def chmod(self, mode):
     self.st_mode &= 0o770000
     self.st_mode |= mode
+    self._metadata = None
 
   def chown(self, uid, gid):
     self.st_uid = uid
     self.st_gid = gid
+    self._metadata = None
+
+  def set_attr(self, name: str, value: bytes):
+    """Set an extended attribute.
+
+    Args:
+      name: The name of the attribute.
+      value: The value of the attribute.
+    """
+    if self.attrs is _NO_ATTRS:
+      self.attrs = {}
+    self.attrs[name] = value
+
+  def remove_attr(self, name: str):
+    """Remove an extended attribute if it is set.
+
+    Args:
+      name: The name of the attribute.
+    """
+    if name in self.attrs:
+      del self.attrs[name]
+      if len(self.attrs) == 0:
+        self.attrs = _NO_ATTRS
 
 
 class File(FileBase):
   """Represents a file backed by the object store."""
 
-  def __init__(self, file: Dict):
+  __slots__ = ('file_id', '_is_local', 'remote_name', 'content_sha1',
+               'st_size', 'st_mtime', 'st_ctime', 'st_atime')
+
+  # Files have no hard links, so share the count instead of storing it
+  st_nlink = 1
+
+  def __init__(self, file: Dict, name: str = None):
     """Create a file object.
 
     Args:
       file: A dictionary of file metadata from B2.
+      name: The name of the file in its directory, defaults to the B2 name.
     """
-    super().__init__(file.get('fileName', ''))
+    super().__init__(file.get('fileName', '') if name is None else name)
     self.file_id = file.get('fileId', str(uuid4()))
+    # Files without a B2 id only exist locally until they are uploaded
+    self._is_local = 'fileId' not in file
+    # Name the current version is stored under in B2, which lags behind renames
+    # until the file is uploaded again
+    self.remote_name = file.get('fileName') if 'fileId' in file else None
+    # SHA1 of the contents stored in B2, if known
+    self.content_sha1 = file.get('contentSha1')
     self.st_size = file.get('contentLength', 0)
-    self.st_mtime = file.get('uploadTimestamp', time() * 1e3) * 1e-3
+    upload_timestamp = file.get('uploadTimestamp')
+    if upload_timestamp is None:
+      self.st_mtime = time()
+    else:
+      # B2 reports timestamps in milliseconds
+      self.st_mtime = upload_timestamp * 1e-3
     self.st_ctime = self.st_mtime
     self.st_atime = self.st_mtime
     self.st_mode = S_IFREG | 0o755
-    self.st_nlink = 1
 
   def __repr__(self):
     return '<File {}>'.format(self.name)
@@ -52,48 +129,63 @@ class File(FileBase):
   @property
   def is_local_file(self) -> bool:
     """Whether this file is local only, and not on the server."""
-    try:
-      UUID(self.file_id)
-      return True
-    except:
-      return False
+    return self._is_local
 
   @property
   def metadata(self) -> Dict:
-    return {
-        'st_mode': self.st_mode,
-        'st_ctime': self.st_ctime,
-        'st_mtime': self.st_mtime,
-        'st_atime': self.st_atime,
-        'st_nlink': self.st_nlink,
-        'st_size': self.st_size
-    }
+    if self._metadata is None:
+      self._metadata = {
+          'st_mode': self.st_mode,
+          'st_ctime': self.st_ctime,
+          'st_mtime': self.st_mtime,
+          'st_atime': self.st_atime,
+          'st_nlink': self.st_nlink,
+          'st_size': self.st_size
+      }
+    return self._metadata
 
   def update(self,
              file_id: str = None,
              file_size: int = None,
              modify_time: str = None,
-             access_time: int = None):
+             access_time: int = None,
+             content_sha1: str = None,
+             remote_name: str = None):
     """Update the file metadata.
     Automatically updates the last modified time.
 
     Args:
       file_id: The new file id.
       file_size: The new file size.
+      content_sha1: The SHA1 of the contents stored under the new file id.
+      remote_name: The name the new file id is stored under in B2.
     """
     if file_id:
       self.file_id = file_id
-    if file_size:
+      self._is_local = False
+      self.content_sha1 = content_sha1
+      self.remote_name = remote_name
+    if file_size is not None:
       self.st_size = file_size
     if modify_time:
+      old_mtime = self.st_mtime
       self.st_mtime = modify_time
+      if self._parent is not None:
+        self._parent._child_mtime_changed(old_mtime, modify_time)
     if access_time:
       self.st_atime = access_time
+    self._metadata = None
 
 
 class Directory(FileBase):
   """A virtual directory containing subfiles and directories."""
 
+  __slots__ = ('mode', 'st_atime', 'b2', 'bucket_id', 'files',
+               'last_update_time', 'update_period', '_is_local', '_flat',
+               '_mtime', '_nlink')
+
+  is_dir = True
+
   def __init__(self,
                b2: B2,
                bucket_id: str,
@@ -121,6 +213,16 @@ class Directory(FileBase):
     self.last_update_time = None
     self.update_period = update_period
 
+    # Directories made locally only show up in listings once they hold a file
+    self._is_local = False
+
+    # Flat index from path strings to resolved nodes below this directory
+    self._flat = {}
+
+    # Cached stats, kept up to date as children change
+    self._mtime = self.st_atime
+    self._nlink = 2
+
   def _should_update(self) -> bool:
     # If we have never updated yet, we should
     if self.last_update_time is None:
@@ -139,72 +241,246 @@ class Directory(FileBase):
     Args:
       chunk_size: How many files to load in each request.
     """
-    # Iterate to get all the direct children
-    self.files = {}
-    start_file_name = None
-
-    while True:
-      file_info = self.b2.list_files(
-          self.bucket_id,
-          start_file_name=start_file_name,
-          prefix=self.name,
-          list_directory=True,
-          limit=chunk_size)
-      for info in file_info:
-        key = info['fileName'].strip('/').split('/')[-1]
-        if info['action'] == 'folder':
-          # This is a directory
-          self.files[key] = Directory(
-              self.b2,
-              self.bucket_id,
-              info['fileName'],
-              mode=self.mode,
-              update_period=self.update_period)
-        else:
-          # This is a file
-          self.files[key] = File(info)
-
-      if len(file_info) < chunk_size:
-        break
-      start_file_name = file_info[-1]['fileName']
-
+    # Iterate to get all the direct children. Build the listing off to the
+    # side and swap it in at the end, so lookups never see a partial listing.
+    # Nodes that did not change are kept, along with anything loaded under them.
+    old_files = self.files
+    files = {}
+    num_subdirs = 0
+    prefix_length = len(self.name)
+    list_files = partial(
+        self.b2.list_files,
+        self.bucket_id,
+        prefix=self.name,
+        list_directory=True,
+        limit=chunk_size)
+    file_info = list_files(start_file_name=None)
+    executor = None
+    try:
+      while True:
+        # If the page is full, request the next one while processing this one
+        next_file_info = None
+        if len(file_info) >= chunk_size:
+          if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+          next_file_info = executor.submit(
+              list_files, start_file_name=file_info[-1]['fileName'])
+
+        for info in file_info:
+          # Listed names are direct children, so the key is whatever follows
+          # the prefix, without the trailing slash on folders. Names repeat
+          # across the tree, so intern them to share one string per name.
+          key = intern(info['fileName'][prefix_length:].rstrip('/'))
+          old_file = old_files.get(key)
+          if info['action'] == 'folder':
+            # This is a directory
+            if old_file is not None and old_file.is_dir:
+              file = old_file
+              file._is_local = False
+            else:
+              file = Directory(
+                  self.b2,
+                  self.bucket_id,
+                  info['fileName'],
+                  mode=self.mode,
+                  update_period=self.update_period)
+            num_subdirs += 1
+          elif (old_file is not None and not old_file.is_dir and
+                old_file.file_id == info['fileId']):
+            file = old_file
+          else:
+            # This is a file
+            file = File(info, name=key)
+          file._parent = self
+          files[key] = file
+
+        if next_file_info is None:
+          break
+        file_info = next_file_info.result()
+    finally:
+      if executor is not None:
+        executor.shutdown()
+
+    # Files that have not been uploaded yet are not listed, and neither are
+    # directories holding only such files, so carry them over
+    for key, file in list(old_files.items()):
+      if key in files:
+        continue
+      if file.is_dir:
+        if file._has_local_nodes():
+          files[key] = file
+          num_subdirs += 1
+      elif file.is_local_file:
+        files[key] = file
+
+    self.files = files
+    self._nlink = 2 + num_subdirs
     self.last_update_time = time()
+    self._metadata = None
+    self._recompute_mtime()
+
+  def _has_local_nodes(self) -> bool:
+    """
+    Returns:
+      Whether this directory, or anything loaded under it, is not in B2 yet.
+    """
+    directories = [self]
+    while directories:
+      directory = directories.pop()
+      if directory._is_local:
+        return True
+      for file in directory.files.values():
+        if file.is_dir:
+          directories.append(file)
+        elif file.is_local_file:
+          return True
+    return False
+
+  def local_files(self) -> List[Tuple[str, File]]:
+    """
+    Returns:
+      The path and node of every loaded file under this directory that has
+      not been uploaded yet.
+    """
+    local_files = []
+    directories = [('', self)]
+    while directories:
+      prefix, directory = directories.pop()
+      for key, file in directory.files.items():
+        path = '{}/{}'.format(prefix, key)
+        if file.is_dir:
+          directories.append((path, file))
+        elif file.is_local_file:
+          local_files.append((path, file))
+    return local_files
+
+  def refresh(self):
+    """Reload every directory under this one that has been listed before."""
+    directories = [self]
+    while directories:
+      directory = directories.pop()
+      if directory.last_update_time is None:
+        continue
+      directory._update()
+      directories.extend([f for f in directory.files.values() if f.is_dir])
+
+    # Replaced nodes may still be in the flat index, so rebuild it lazily
+    self._flat = {}
+
+  def _set_mtime(self, mtime: float):
+    """Set the cached mtime and pass the change on to the parent.
+
+    Args:
+      mtime: The new last modified time of the directory.
+    """
+    old_mtime = self._mtime
+    if mtime == old_mtime:
+      return
+    self._mtime = mtime
+    self._metadata = None
+    if self._parent is not None:
+      self._parent._child_mtime_changed(old_mtime, mtime)
+
+  def _recompute_mtime(self):
+    """Recompute the mtime from scratch, from the children's mtimes."""
+    if len(self.files) == 0:
+      self._set_mtime(self.st_atime)
+    else:
+      self._set_mtime(max([f.st_mtime for f in self.files.values()]))
+
+  def _child_mtime_changed(self, old_mtime: float, new_mtime: float):
+    """Update the cached mtime after the mtime of a child changed.
+
+    Args:
+      old_mtime: The previous mtime of the child.
+      new_mtime: The new mtime of the child.
+    """
+    if new_mtime >= self._mtime:
+      self._set_mtime(new_mtime)
+    elif old_mtime == self._mtime:
+      # The child held the latest time and moved back, so find the new latest
+      self._recompute_mtime()
+
+  def _add_child(self, name: str, file: FileBase):
+    """Add a file or directory, replacing any existing entry.
+
+    Args:
+      name: The name of the entry in this directory.
+      file: The node to add.
+    """
+    self._remove_child(name)
+    file._parent = self
+    self.files[intern(name)] = file
+    if file.is_dir:
+      self._nlink += 1
+      self._metadata = None
+    if len(self.files) == 1 or file.st_mtime > self._mtime:
+      self._set_mtime(file.st_mtime)
+
+  def _remove_child(self, name: str):
+    """Remove an entry from this directory if it exists.
+
+    Args:
+      name: The name of the entry to remove.
+    """
+    file = self.files.pop(name, None)
+    if file is None:
+      return
+    if file.is_dir:
+      self._nlink -= 1
+      self._metadata = None
+    if len(self.files) == 0 or file.st_mtime == self._mtime:
+      self._recompute_mtime()
 
   @property
   def st_mtime(self) -> float:
     """The last modified time of the directory."""
-    if len(self.files) == 0:
-      return self.st_atime
-    return max([f.st_mtime for f in self.files.values()])
+    return self._mtime
 
   @property
   def st_nlink(self) -> int:
     """Number of hard links pointing to the directory."""
-    return 2 + len([f for f in self.files.values() if type(f) == Directory])
+    return self._nlink
 
   @property
   def metadata(self) -> Dict:
-    return {
-        'st_mode': self.st_mode,
-        'st_ctime': self.st_mtime,
-        'st_mtime': self.st_mtime,
-        'st_atime': self.st_mtime,
-        'st_nlink': self.st_nlink
-    }
+    if self._metadata is None:
+      self._metadata = {
+          'st_mode': self.st_mode,
+          'st_ctime': self._mtime,
+          'st_mtime': self._mtime,
+          'st_atime': self._mtime,
+          'st_nlink': self.st_nlink
+      }
+    return self._metadata
 
   @staticmethod
-  def _to_path_list(path: Union[str, List[str]]) -> List[str]:
+  def _to_path_list(path: Union[str, List[str]]) -> Tuple[str, ...]:
     """Combine a path to a path list.
 
     Args:
       path: The path to convert (can be a string or a list)
 
     Returns:
-      A list that can be used to find the node in the tree.
+      A tuple that can be used to find the node in the tree.
     """
     if type(path) == str:
-      path = path.strip('/').split('/')
-    return path
+      return _split_path(path)
+    return tuple(path)
+
+  @staticmethod
+  def _to_path_key(path: Union[str, List[str]]) -> str:
+    """Convert a path to its key in the flat index.
+
+    Args:
+      path: The path to convert (can be a string or a list)
+
+    Returns:
+      The path without leading or trailing slashes.
+    """
+    if type(path) == str:
+      return path.strip('/')
+    return '/'.join(path)
 
   def file_nesting(self, path: Union[str, List[str]]) -> List['Directory']:
     """Get the nesting directories of a file or directory.
@@ -220,13 +496,19 @@ class Directory(FileBase):
       self._update()
 
     path = self._to_path_list(path)
+    nesting = [self]
     if path[0] == '':
-      return [self]
-    file = self.files[path[0]]
-    if len(path) == 1:
-      # The file is in the root directory
-      return [self, file]
-    return [self] + file.file_nesting(path[1:])
+      return nesting
+
+    file = self
+    for name in path:
+      if not file.is_dir:
+        raise KeyError('{} is not a directory'.format(file.name))
+      if file._should_update():
+        file._update()
+      file = file.files[name]
+      nesting.append(file)
+    return nesting
 
   def file_at_path(self, path: Union[str, List[str]]) -> File:
     """Get the file given a path relative to this directory.
@@ -237,7 +519,55 @@ class Directory(FileBase):
     Returns:
       The file object at the path if it exists.
     """
-    return self.file_nesting(path)[-1]
+    if self.update_period != 0.0:
+      # Directory contents may be reloaded, so always walk the tree
+      return self.file_nesting(path)[-1]
+
+    key = self._to_path_key(path)
+    file = self._flat.get(key)
+    if file is None:
+      file = self.file_nesting(path)[-1]
+      self._flat[key] = file
+    return file
+
+  def try_file_at_path(self, path: Union[str, List[str]]) -> Optional[FileBase]:
+    """Get the file given a path relative to this directory, if it exists.
+
+    Unlike file_at_path, a missing file is not an error, so negative lookups
+    do not have to raise and catch an exception.
+
+    Args:
+      path: The path of the file to query.
+
+    Returns:
+      The file object at the path, or None if there is no such file.
+    """
+    use_index = self.update_period == 0.0
+    if use_index:
+      key = self._to_path_key(path)
+      file = self._flat.get(key)
+      if file is not None:
+        return file
+
+    # Update the directory contents if needed
+    if self._should_update():
+      self._update()
+
+    path = self._to_path_list(path)
+    file = self
+    if path[0] != '':
+      for name in path:
+        if not file.is_dir:
+          return None
+        if file._should_update():
+          file._update()
+        file = file.files.get(name)
+        if file is None:
+          return None
+
+    if use_index:
+      self._flat[key] = file
+    return file
 
   def file_exists(self, path: str) -> bool:
     """
@@ -247,11 +577,7 @@ class Directory(FileBase):
     Returns:
       Whether the file exists.
     """
-    try:
-      self.file_at_path(path)
-      return True
-    except KeyError:
-      return False
+    return self.try_file_at_path(path) is not None
 
   def _find_node(self, path: Union[str, List[str]]) -> FileBase:
     """Find the node in the directory tree.
@@ -262,15 +588,14 @@ class Directory(FileBase):
     Returns:
       The found node.
     """
-    path = self._to_path_list(path)
-    if len(path) == 0:
-      return self
-
-    if (path[0] not in self.files or type(self.files[path[0]]) != Directory):
-      raise KeyError('Cannot find node, directory {} does not exist'.format(
-          path[0]))
-
-    return self.files[path[0]]._find_node(path[1:])
+    node = self
+    for name in self._to_path_list(path):
+      file = node.files.get(name)
+      if file is None or not file.is_dir:
+        raise KeyError('Cannot find node, directory {} does not exist'.format(
+            name))
+      node = file
+    return node
 
   def mkdir(self, path: Union[str, List[str]], mode: int):
     """Create a subdirectory.
@@ -283,12 +608,17 @@ class Directory(FileBase):
     node = self._find_node(path[:-1])
     if path[-1] in node.files:
       raise KeyError('Directory {} already exists'.format(path))
-    node.files[path[-1]] = Directory(
+    directory = Directory(
         self.b2,
         self.bucket_id,
-        path[-1],
+        '{}{}/'.format(node.name, path[-1]),
         mode=mode,
         update_period=self.update_period)
+    # The directory is new, so there is nothing to list from the store yet
+    directory.last_update_time = time()
+    directory._is_local = True
+    node._add_child(path[-1], directory)
+    self._flat[self._to_path_key(path)] = directory
 
   def rm(self, path: Union[str, List[str]]):
     """Remove a file or directory.
@@ -296,11 +626,39 @@ class Directory(FileBase):
     Args:
       name: The path to the file.
     """
+    path = self._to_path_list(path)
     nesting = self.file_nesting(path)
     if len(nesting) < 2:
       raise ValueError('Cannot rm the root directory')
     parent_dir, file = nesting[-2:]
-    del parent_dir.files[file.name]
+    parent_dir._remove_child(path[-1])
+
+    # Drop the node, and anything nested under it, from the flat index
+    key = self._to_path_key(path)
+    self._flat.pop(key, None)
+    if file.is_dir:
+      prefix = key + '/'
+      for nested_key in [k for k in self._flat if k.startswith(prefix)]:
+        del self._flat[nested_key]
+
+  def move(self, old_path: Union[str, List[str]],
+           new_path: Union[str, List[str]]):
+    """Move a file to a new path, replacing any entry already there.
+
+    Args:
+      old_path: The current path to the file.
+      new_path: The path to move the file to.
+    """
+    old_path = self._to_path_list(old_path)
+    new_path = self._to_path_list(new_path)
+    node = self._find_node(new_path[:-1])
+    file = self.file_nesting(old_path)[-1]
+    if file.is_dir:
+      raise ValueError('Cannot move directory {}'.format(file.name))
+    self.rm(old_path)
+    file.name = new_path[-1]
+    node._add_child(new_path[-1], file)
+    self._flat[self._to_path_key(new_path)] = file
 
   def touch(self, path: Union[str, List[str]], mode: int) -> File:
     """Create an empty file.
@@ -312,5 +670,58 @@ class Directory(FileBase):
     path = self._to_path_list(path)
     node = self._find_node(path[:-1])
     file = File({'fileName': path[-1]})
-    node.files[path[-1]] = file
+    node._add_child(path[-1], file)
+    self._flat[self._to_path_key(path)] = file
     return file
+
+
+class _TreePickler(pickle.Pickler):
+  """Pickle a directory tree, leaving out the B2 client it was loaded with."""
+
+  def persistent_id(self, obj):
+    if isinstance(obj, B2):
+      return 'b2'
+    if obj is _NO_ATTRS:
+      return 'no_attrs'
+    return None
+
+
+class _TreeUnpickler(pickle.Unpickler):
+  """Unpickle a directory tree, attaching it to a B2 client."""
+
+  def __init__(self, f: BinaryIO, b2: B2):
+    super().__init__(f)
+    self.b2 = b2
+
+  def persistent_load(self, pid):
+    if pid == 'b2':
+      return self.b2
+    if pid == 'no_attrs':
+      return _NO_ATTRS
+    raise pickle.UnpicklingError('Unknown persistent id {}'.format(pid))
+
+
+def save_tree(root: Directory, f: BinaryIO):
+  """Write a snapshot of a directory tree.
+
+  Args:
+    root: The root of the tree to save.
+    f: The binary file to write to.
+  """
+  _TreePickler(f, pickle.HIGHEST_PROTOCOL).dump(root)
+
+
+def load_tree(f: BinaryIO, b2: B2) -> Directory:
+  """Read a snapshot of a directory tree written by save_tree.
+
+  Args:
+    f: The binary file to read from.
+    b2: The B2 instance for the tree to get data from.
+
+  Returns:
+    The root of the tree.
+  """
+  root = _TreeUnpickler(f, b2).load()
+  if not isinstance(root, Directory):
+    raise ValueError('Snapshot does not contain a directory tree')
+  return root
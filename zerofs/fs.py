@@ -1,21 +1,32 @@
-from collections import defaultdict
-from errno import ENOENT, ENOTEMPTY, EINVAL
+import hashlib
+import os
+from collections import Counter
+from errno import EFBIG, EIO, ENOENT, ENOTEMPTY, EINVAL
 from logging import getLogger
 from stat import S_IFDIR, S_IFLNK
-from threading import Lock
+from threading import Event, Lock
 from time import time
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from b2py import B2, utils as b2_utils
-from fuse import FuseOSError, Operations, LoggingMixIn
-from zerofs.cache import Cache
-from zerofs.file import Directory, File
-from zerofs.task_queue import TaskQueue
+from fuse import FuseOSError, Operations
+from zerofs.cache import Cache, HIDDEN_PREFIX
+from zerofs.file import Directory, File, load_tree, save_tree
+from zerofs.task_queue import RunState, TaskQueue
 
 logger = getLogger('zerofs')
 
+# Number of locks that file ids are spread across
+NUM_LOCK_STRIPES = 256
 
-class ZeroFS(LoggingMixIn, Operations):
+# Seconds fsync waits for an upload before reporting an I/O error
+FSYNC_TIMEOUT = 60.0
+
+# Name of the directory tree snapshot saved in the cache dir between mounts
+SNAPSHOT_NAME = HIDDEN_PREFIX + 'tree'
+
+
+class ZeroFS(Operations):
   """Virtual filesystem backed by the B2 object store."""
 
   def __init__(self,
@@ -38,7 +49,13 @@ class ZeroFS(LoggingMixIn, Operations):
     self.bucket_name = bucket_name
     self.cache = Cache(cache_dir, cache_size)
     self.b2 = B2()
-    self.file_locks = defaultdict(Lock)
+    # Guard per file operations with a fixed set of locks, picked by file id
+    self.file_locks = [Lock() for _ in range(NUM_LOCK_STRIPES)]
+    # Map from file id to an event set once its ongoing download finishes
+    self.downloads = {}
+    self.downloads_lock = Lock()
+    # Counts of requests made to the object store
+    self.metrics = Counter()
     self.upload_delay = upload_delay
 
     # Initialize the root directory
@@ -48,8 +65,14 @@ class ZeroFS(LoggingMixIn, Operations):
       raise ValueError('Create a bucket named {} to enable zerofs.'.format(
           self.bucket_name))
     self.bucket_id = bucket[0]['bucketId']
-    self.root = Directory(
-        self.b2, self.bucket_id, '', update_period=update_period)
+    self.update_period = update_period
+    self.snapshot_path = os.path.join(cache_dir, SNAPSHOT_NAME)
+    self.root = self._load_snapshot()
+    # Whether the tree came from a snapshot that may be out of date
+    self.from_snapshot = self.root is not None
+    if not self.from_snapshot:
+      self.root = Directory(
+          self.b2, self.bucket_id, '', update_period=update_period)
     self.fd = 0
 
     # Initialize the task queue
@@ -58,10 +81,78 @@ class ZeroFS(LoggingMixIn, Operations):
   def init(self, _):
     """Start the background task queue."""
     self.task_queue.start()
+    if self.from_snapshot:
+      # Serve from the snapshot right away, and catch up with the store
+      self.task_queue.submit_task('refresh', 0, self._refresh_snapshot)
+
+  def _refresh_snapshot(self):
+    """Reload a tree restored from a snapshot, and upload its local files.
+
+    The uploads are only submitted once the listing is done, so a file that is
+    uploaded in the meantime is not dropped for missing from the listing.
+    """
+    self.root.refresh()
+    for path, file in self.root.local_files():
+      if self.cache.has(file.file_id):
+        self._submit_upload(file, path)
+      else:
+        logger.info('Contents of %s are no longer cached, cannot upload', path)
+
+  def destroy(self, _):
+    """Finish pending uploads and save a snapshot of the directory tree."""
+    # Failed tasks are not retried while the queue stops, so this is bounded.
+    # Local files that did not make it are uploaded again on the next mount.
+    try:
+      if self.task_queue.run_state == RunState.RUNNING:
+        self.task_queue.stop(finish_ongoing_tasks=True)
+    finally:
+      self._save_snapshot()
+
+  def _load_snapshot(self) -> Optional[Directory]:
+    """
+    Returns:
+      The directory tree saved by the last mount of the bucket, if any.
+    """
+    try:
+      with open(self.snapshot_path, 'rb') as f:
+        root = load_tree(f, self.b2)
+    except FileNotFoundError:
+      return None
+    except Exception as e:
+      logger.info('Could not load snapshot: %s', str(e))
+      return None
+
+    if (root.bucket_id != self.bucket_id or
+        root.update_period != self.update_period):
+      logger.info('Snapshot is for a different mount, ignoring it')
+      return None
+    return root
+
+  def _save_snapshot(self):
+    """Save the directory tree to the cache dir."""
+    temp_path = self.snapshot_path + '.tmp'
+    try:
+      with open(temp_path, 'wb') as f:
+        save_tree(self.root, f)
+      os.replace(temp_path, self.snapshot_path)
+    except Exception as e:
+      logger.info('Could not save snapshot: %s', str(e))
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+  def _file_lock(self, file_id: str) -> Lock:
+    """
+    Args:
+      file_id: The file to lock.
+
+    Returns:
+      The lock guarding the file.
+    """
+    return self.file_locks[hash(file_id) % NUM_LOCK_STRIPES]
 
   @staticmethod
   def _to_bytes(s: Union[str, bytes]):
-    if type(s) == bytes:
+    if isinstance(s, (bytes, bytearray, memoryview)):
       return s
     return s.encode('utf-8')
 
@@ -100,20 +191,130 @@ class ZeroFS(LoggingMixIn, Operations):
     """
     logger.info('create %s %s', path, mode)
     file = self.root.touch(path, mode)
-    self.cache.add(file.file_id, self._to_bytes(''))
-    self.task_queue.submit_task(file.file_id, self.upload_delay,
-                                self._upload_file, path)
+    self.cache.add(file.file_id, b'')
+    self._submit_upload(file, path)
     return self.open()
 
-  def open(self, _=None, __=None) -> int:
+  def open(self, path: str = None, flags: int = 0) -> int:
     """Increment the file descriptor.
 
+    If the file is not cached yet and is opened for reading, start downloading
+    it in the background so the first read does not pay the full round trip to
+    the object store.
+
+    Args:
+      path: The path to the file being opened.
+      flags: The flags the file is opened with.
+
     Returns:
       A new file descriptor.
     """
+    # Opens that truncate or only write do not read the old contents
+    will_read = (not (flags & os.O_TRUNC) and
+                 (flags & os.O_ACCMODE) != os.O_WRONLY)
+    if path is not None and will_read:
+      file = self.root.file_at_path(path)
+      # Files larger than the cache would be downloaded just to be dropped
+      if (0 < file.st_size <= self.cache.cache_size and
+          not self.cache.has(file.file_id)):
+        self.task_queue.submit_task('prefetch:' + path, 0,
+                                    self._prefetch_file, path)
     self.fd += 1
     return self.fd
 
+  def _download_file(self, file: File) -> Optional[bytes]:
+    """Download a file into the cache if it is not already there.
+
+    Concurrent calls for the same file share a single download, and each call
+    downloads at most once. The caller must not hold the lock for the file, so
+    it is not held over the network.
+
+    Args:
+      file: The file to download.
+
+    Returns:
+      The downloaded contents, or None if the file was already cached. Files
+      larger than the whole cache are returned without being cached.
+    """
+    file_id = file.file_id
+    with self.downloads_lock:
+      if self.cache.has(file_id):
+        return None
+      download = self.downloads.get(file_id)
+      if download is None:
+        self.downloads[file_id] = Event()
+    if download is not None:
+      # Someone else is downloading the file, share their result if it is still
+      # cached, or fetch it again ourselves if it has already been evicted
+      download.wait()
+      if self.cache.has(file_id):
+        return None
+
+    try:
+      logger.info('File not in cache, downloading from store')
+      self.metrics['b2_gets'] += 1
+      contents = self._to_bytes(self.b2.download_file(file_id))
+      logger.info('File downloaded %s', len(contents))
+      if len(contents) > self.cache.cache_size:
+        logger.info('File larger than the cache, not caching it %s', file_id)
+        return contents
+      with self._file_lock(file_id):
+        if not self.cache.has(file_id):
+          self.cache.add(file_id, contents)
+      return contents
+    finally:
+      if download is None:
+        with self.downloads_lock:
+          self.downloads.pop(file_id).set()
+
+  def _prefetch_file(self, path: str):
+    """Download a file into the cache ahead of the first read.
+
+    Prefetching is best effort, the read path downloads the file itself if
+    this fails.
+
+    Args:
+      path: The path to the file to download.
+    """
+    try:
+      file = self.root.file_at_path(path)
+      self._download_file(file)
+    except Exception as e:
+      logger.info('Prefetch of %s failed: %s', path, str(e))
+
+  def fsync(self, path: str, _, __=None):
+    """Upload a file now, and wait until it is in the object store.
+
+    Args:
+      path: The path to the file.
+
+    Raises:
+      FuseOSError: If the upload does not succeed in time.
+    """
+    logger.info('fsync %s', path)
+    file = self._flush_upload(path)
+    if file is None:
+      return
+    if not self.task_queue.wait_for_task(self._upload_task_id(file),
+                                         FSYNC_TIMEOUT):
+      logger.info('Upload of %s did not finish in time', path)
+      raise FuseOSError(EIO)
+
+  def _flush_upload(self, path: str) -> Optional[File]:
+    """Run the pending upload of a file, if there is one, right away.
+
+    Args:
+      path: The path to the file.
+
+    Returns:
+      The file, or None if there is no file at the path.
+    """
+    file = self.root.try_file_at_path(path)
+    if file is None or file.is_dir:
+      return None
+    self.task_queue.expedite_task(self._upload_task_id(file))
+    return file
+
   def getattr(self, path: str, _) -> Dict:
     """
     Args:
@@ -122,9 +323,10 @@ class ZeroFS(LoggingMixIn, Operations):
     Returns:
       The file metadata.
     """
-    if not self.root.file_exists(path):
+    file = self.root.try_file_at_path(path)
+    if file is None:
       raise FuseOSError(ENOENT)
-    return self.root.file_at_path(path).metadata
+    return file.metadata
 
   def getxattr(self, path: str, name: str, _=None) -> str:
     """Read a file attribute.
@@ -137,9 +339,7 @@ class ZeroFS(LoggingMixIn, Operations):
       The value of the attribute for the file.
     """
     file = self.root.file_at_path(path)
-    if name in file.attrs:
-      return file.attrs[name]
-    return ''.encode('utf-8')
+    return file.attrs.get(name, b'')
 
   def listxattr(self, path: str) -> List[str]:
     """
@@ -150,7 +350,7 @@ class ZeroFS(LoggingMixIn, Operations):
       The file's extra attributes.
     """
     file = self.root.file_at_path(path)
-    return file.attrs.keys()
+    return list(file.attrs.keys())
 
   def mkdir(self, path: str, mode: int):
     """Create a new directory.
@@ -175,24 +375,21 @@ class ZeroFS(LoggingMixIn, Operations):
     """
     logger.info('read %s %s %s', path, offset, size)
     file = self.root.file_at_path(path)
-    logger.info('Found file %s', file.file_id)
 
     if file.st_size == 0:
       # Special case for empty files
-      logger.info('File size %s', 0)
-      return self._to_bytes('')
+      return b''
 
-    with self.file_locks[file.file_id]:
-      # Download from the object store if the file is not cached
-      if not self.cache.has(file.file_id):
-        logger.info('File not in cache, downloading from store')
-        contents = self._to_bytes(self.b2.download_file(file.file_id))
-        logger.info('File downloaded %s', len(contents))
-        self.cache.add(file.file_id, contents)
+    # Download from the object store if the file is not cached
+    contents = self._download_file(file)
 
-      content = self.cache.get(file.file_id, offset, size)
-      logger.info('Reading bytes %s', len(content))
-      return content
+    with self._file_lock(file.file_id):
+      if contents is not None and not self.cache.has(file.file_id):
+        # Too large to cache, or evicted again already, so serve from the
+        # downloaded copy
+        end = offset + size if size is not None else None
+        return contents[offset:end]
+      return self.cache.get(file.file_id, offset, size)
 
   def readdir(self, path: str, _) -> List[str]:
     """Read the entries in the directory.
@@ -219,6 +416,15 @@ class ZeroFS(LoggingMixIn, Operations):
     logger.info('readlink %s', path)
     return self.read(path, None, 0)
 
+  def release(self, path: str, _=None):
+    """Close a file, uploading it right away if it was written to.
+
+    Args:
+      path: The path to the file.
+    """
+    logger.info('release %s', path)
+    self._flush_upload(path)
+
   def removexattr(self, path: str, name: str):
     """Remove an attribute from a file.
 
@@ -227,11 +433,13 @@ class ZeroFS(LoggingMixIn, Operations):
       name: Name of the attribute to remove.
     """
     file = self.root.file_at_path(path)
-    if name in file.attrs:
-      del file.attrs[name]
+    file.remove_attr(name)
 
   def rename(self, old: str, new: str):
-    """Rename a file by deleting and recreating it.
+    """Rename a file.
+
+    The file keeps its cached contents, and is uploaded under the new name.
+    The version stored under the old name is deleted once that is done.
 
     Args:
       old: The old path of the file.
@@ -239,17 +447,19 @@ class ZeroFS(LoggingMixIn, Operations):
     """
     logger.info('rename %s %s', old, new)
     file = self.root.file_at_path(old)
-    if type(file) == Directory:
+    if file.is_dir:
       if len(file.files) > 0:
         logger.info('Directory not empty')
         return ENOTEMPTY
       self.rmdir(old)
       self.mkdir(new, file.st_mode)
     else:
-      contents = self.readlink(old)
-      self.unlink(old)
-      self.create(new, file.st_mode)
-      self.write(new, contents, 0)
+      target = self.root.try_file_at_path(new)
+      if target is not None and not target.is_dir:
+        self.unlink(new)
+      with self._file_lock(file.file_id):
+        self.root.move(old, new)
+        self._submit_upload(file, new)
 
   def rmdir(self, path):
     """Remove a directory, if it is not empty.
@@ -272,7 +482,7 @@ class ZeroFS(LoggingMixIn, Operations):
       value: Value of the attribute.
     """
     file = self.root.file_at_path(path)
-    file.attrs[name] = value
+    file.set_attr(name, value)
 
   def statfs(self, _):
     """Get file system stats."""
@@ -295,10 +505,27 @@ class ZeroFS(LoggingMixIn, Operations):
       path: The file to truncate.
       length: The desired lenght.
     """
+    logger.info('truncate %s %s', path, length)
     file = self.root.file_at_path(path)
-    content = self.readlink(path)
-    content = content.ljust(length, '\x00'.encode('utf-8'))
-    file.st_size = length
+    if length == file.st_size:
+      return
+
+    if length > 0:
+      # Only download when some of the old contents are kept
+      self._download_file(file)
+
+    with self._file_lock(file.file_id):
+      if length == 0:
+        self.cache.add(file.file_id, b'')
+      elif not self.cache.has(file.file_id):
+        # Files larger than the cache can only be read
+        raise FuseOSError(EFBIG)
+      else:
+        self.cache.truncate(file.file_id, length)
+      file.update(file_size=length)
+
+      # Submit task to upload to object store
+      self._submit_upload(file, path)
 
   def _delete_file(self, path: str):
     """Delete a file from both the local cache and the object store.
@@ -307,13 +534,31 @@ class ZeroFS(LoggingMixIn, Operations):
       path: The path to the file.
     """
     file = self.root.file_at_path(path)
-    with self.file_locks[file.file_id]:
+    # There is nothing left to upload
+    self.task_queue.cancel_task(self._upload_task_id(file))
+    with self._file_lock(file.file_id):
       if self.cache.has(file.file_id):
         logger.info('Deleting from cache %s', file.file_id)
         self.cache.delete(file.file_id)
       if not file.is_local_file:
         logger.info('Deleting from object store %s', file.file_id)
-        self.b2.delete_file(file.file_id, path.strip('/'))
+        self.b2.delete_file(file.file_id, file.remote_name)
+
+  def _delete_version(self, file_id: str, name: str):
+    """Delete an old version of a file from the object store.
+
+    This is best effort. A version left behind under the same name is hidden
+    by the newer one.
+
+    Args:
+      file_id: The id of the version to delete.
+      name: The name of the file in the bucket.
+    """
+    try:
+      logger.info('Deleting old version from object store %s', file_id)
+      self.b2.delete_file(file_id, name)
+    except Exception as e:
+      logger.info('Deleting old version %s failed: %s', file_id, str(e))
 
   def unlink(self, path: str):
     """Delete a file.
@@ -323,7 +568,7 @@ class ZeroFS(LoggingMixIn, Operations):
     """
     logger.info('unlink %s', path)
     file = self.root.file_at_path(path)
-    if type(file) == Directory:
+    if file.is_dir:
       self.rmdir(path)
     else:
       self._delete_file(path)
@@ -341,30 +586,75 @@ class ZeroFS(LoggingMixIn, Operations):
     mtime, atime = times if times else (now, now)
     file.update(modify_time=mtime, access_time=atime)
 
-  def _upload_file(self, path: str) -> str:
-    """Upload a file to the object store.
-
+  @staticmethod
+  def _upload_task_id(file: File) -> str:
+    """
     Args:
-      path: The path of the file to upload.
+      file: The file to upload.
 
+    Returns:
+      The id of the task uploading the file. Unlike the file id, it stays the
+      same across uploads. The task holds on to the node, so the id is not
+      reused by another node while the task is queued.
     """
-    logger.info('upload %s', path)
-    file = self.root.file_at_path(path)
+    return 'upload:{}'.format(id(file))
+
+  def _submit_upload(self, file: File, path: str):
+    """Upload a file once the upload delay has passed.
+
+    Args:
+      file: The file to upload.
+      path: The current path of the file.
+    """
+    self.task_queue.submit_task(self._upload_task_id(file), self.upload_delay,
+                                self._upload_file, file, path)
 
-    # Delete the exisiting version of the file if it exists
-    content = self.cache.get(file.file_id)
+  def _upload_file(self, file: File, path: str):
+    """Upload a file to the object store.
 
-    with self.file_locks[file.file_id]:
+    Args:
+      file: The file to upload.
+      path: The path of the file when the upload was submitted.
+    """
+    logger.info('upload %s', path)
+    if self.root.try_file_at_path(path) is not file:
+      # Renaming resubmits the upload with the new path, and deleting cancels it
+      logger.info('File moved or deleted, skipping upload %s', path)
+      return
+
+    # Renamed files may not have been read since they were last uploaded
+    content = self._download_file(file)
+    with self._file_lock(file.file_id):
+      if content is None or self.cache.has(file.file_id):
+        content = self.cache.get(file.file_id)
+
+    # Writes that leave the contents as they were need no new version, unless
+    # the file was renamed since it was stored
+    name = path.strip('/')
+    content_sha1 = hashlib.sha1(content).hexdigest()
+    if (not file.is_local_file and content_sha1 == file.content_sha1 and
+        file.remote_name == name):
+      logger.info('File unchanged, skipping upload %s', path)
+      return
+
+    with self._file_lock(file.file_id):
       logger.info('Uploading file %s', len(content))
-      response = self.b2.upload_file(self.bucket_id, path.strip('/'), content)
+      response = self.b2.upload_file(self.bucket_id, name, content)
       logger.info('Upload complete, updating cache')
 
-    self._delete_file(path)
+    old_file_id = file.file_id
+    with self._file_lock(old_file_id):
+      if not file.is_local_file:
+        # The new version is stored, so the old one can go in the background
+        self.task_queue.submit_task('delete:' + old_file_id, 0,
+                                    self._delete_version, old_file_id,
+                                    file.remote_name)
 
-    with self.file_locks[file.file_id]:
-      file.update(file_id=response['fileId'], file_size=len(content))
-      logger.info('Saving to cache %s', file.file_id)
-      self.cache.add(file.file_id, content)
+      # The cached bytes are still current, so move them to the new id
+      logger.info('Moving cache entry to %s', response['fileId'])
+      self.cache.rename(old_file_id, response['fileId'])
+      file.update(file_id=response['fileId'], content_sha1=content_sha1,
+                  remote_name=name)
 
   def write(self, path: str, data: str, offset: str, _=None) -> int:
     """Write data to a file.
@@ -380,18 +670,23 @@ class ZeroFS(LoggingMixIn, Operations):
     logger.info('write %s %s %s', path, offset, len(data))
     file = self.root.file_at_path(path)
 
-    with self.file_locks[file.file_id]:
+    # Download the full contents to write on top of
+    self._download_file(file)
+
+    with self._file_lock(file.file_id):
+      if not self.cache.has(file.file_id):
+        # Files larger than the cache can only be read
+        raise FuseOSError(EFBIG)
+
       # Write the new bytes
       data = self._to_bytes(data)
 
       # Immediately save locally
-      logger.info('Writing to cache %s %s', file.file_id, len(data))
       num_bytes = self.cache.update(file.file_id, data, offset)
       file_size = self.cache.file_size(file.file_id)
       file.update(file_size=file_size)
 
       # Submit task to upload to object store
-      self.task_queue.submit_task(file.file_id, self.upload_delay,
-                                  self._upload_file, path)
+      self._submit_upload(file, path)
 
       return num_bytes
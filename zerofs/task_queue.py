@@ -1,13 +1,16 @@
-from collections import defaultdict
 from enum import Enum
+from heapq import heappop, heappush
+from itertools import count
 from logging import getLogger
-from queue import PriorityQueue
-from time import sleep, time
-from threading import Thread, Lock
-from typing import Callable
+from time import monotonic
+from threading import Condition, Event, Thread, Lock
+from typing import Callable, Optional, Tuple
 
 logger = getLogger('task_queue')
 
+# Number of locks that task ids are spread across
+NUM_TASK_LOCKS = 64
+
 
 class Signal(Enum):
   """A special signal to send to a worker queue."""
@@ -30,11 +33,32 @@ class TaskQueue:
       num_workers: How many worker threads to launch to process tasks.
     """
     self.num_workers = num_workers
-    self.queue = PriorityQueue()
-    # Map from task id to latest version number for that task
-    self.tasks = defaultdict(int)
-    self.task_locks = defaultdict(Lock)
+    # Heap of (time to run, sequence number, task id, task version) entries.
+    # Workers wait on the condition until the first entry is due.
+    self.heap = []
+    self.condition = Condition()
+    # Breaks ties between entries due at the same time, in submission order
+    self.sequence = count()
+    # Source of task versions, unique across all tasks so no per task counter
+    # has to be kept around
+    self.versions = count(1)
+    # Map from task id to the latest submission that has not started yet, as
+    # (time to run, version of the queue entry that will run it, fn, args,
+    # kwargs). Resubmitting a waiting task only updates this entry.
+    self.pending = {}
+    # Tasks being run by a worker, a task never runs twice at the same time
+    self.running = set()
+    # Map from task id to the version of its latest submission, kept while the
+    # task is waiting or running, so a run can tell it has been superseded
+    self.generations = {}
+    # Map from task id to an event set once the task has finished running its
+    # latest submission, for callers waiting on it
+    self.waiters = {}
+    self.task_locks = [Lock() for _ in range(NUM_TASK_LOCKS)]
     self.run_state = RunState.STOPPED
+    # Set once stop is called, failed tasks are not retried from then on, so
+    # the remaining tasks always drain
+    self.stopping = Event()
     self.threads = []
 
   def run_worker(self, i, num_retries=5):
@@ -46,65 +70,177 @@ class TaskQueue:
     """
     logger.info('Initialized task worker %s', i)
     while True:
-      # Get the next task.
-      task = self.queue.get()
+      # Wait for the next task that is due.
+      task = self._next_task()
 
       # Check any special signals.
-      if task[1] == Signal.STOP:
+      if task is None:
         break
 
       # Otherwise it is a real task to run.
-      time_to_run, task_args = task
-      task_id, task_version, fn, args, kwargs = task_args
+      task_id, task_version, generation, fn, args, kwargs = task
       logger.info('Worker received task %s', task_id)
-      logger.info('Task queue size %s', self.queue.qsize())
-
-      # If there is a newer version of the task, skip this one
-      with self.task_locks[task_id]:
-        if self.tasks[task_id] > task_version:
-          logger.info('Task cancelled')
-          self.queue.task_done()
-          continue
-
-      # Sleep until we are ready to run the code
-      time_to_sleep = max(1, time_to_run - time())
-      logger.info('Time to sleep %s', time_to_sleep)
-      if time_to_sleep > 0:
-        sleep(time_to_sleep)
-
-      # Make this check again
-      with self.task_locks[task_id]:
-        if self.tasks[task_id] > task_version:
-          logger.info('Task cancelled')
-          self.queue.task_done()
-          continue
 
       # Run the function, retry on failures
       finished = False
-      for backoff in [2**i for i in range(num_retries + 1)]:
+      backoff = 1
+      for _ in range(num_retries + 1):
         try:
           fn(*args, **kwargs)
           finished = True
           break
         except Exception as e:
           logger.info('An error occurred: %s', str(e))
-          logger.info('Sleeping %s', backoff)
-          sleep(backoff)
-
-      # Put the task back in the queue if we still failed
-      if not finished:
-        logger.info('Task failed, reinserting into queue %s', task_id)
-        self.queue.put(task)
 
-      self.queue.task_done()
+        # A newer submission runs once this one is done, so stop retrying
+        with self._task_lock(task_id):
+          if not self._is_current(task_id, generation):
+            logger.info('Task superseded %s', task_id)
+            break
+        logger.info('Sleeping %s', backoff)
+        if self.stopping.wait(backoff):
+          break
+        backoff *= 2
+
+      with self._task_lock(task_id):
+        self.running.discard(task_id)
+        # Put the task back in the queue if we still failed, unless it has been
+        # submitted again since it started
+        if not finished and self._is_current(task_id, generation):
+          if self.stopping.is_set():
+            logger.info('Task failed while stopping, dropping it %s', task_id)
+          else:
+            logger.info('Task failed, reinserting into queue %s', task_id)
+            self.pending[task_id] = (monotonic(), task_version, fn, args,
+                                     kwargs)
+        # Entries that came due while the task was running were dropped
+        pending = self.pending.get(task_id)
+        if pending is None:
+          # Nothing is left to run, so forget the task
+          self.generations.pop(task_id, None)
+          self._wake_waiters(task_id)
+      if pending is not None:
+        self._push(pending[0], task_id, pending[1])
 
     logger.info('Worker %s exiting', i)
 
+  def _push(self, time_to_run: float, task_id, task_version: int = None):
+    """Add an entry to the heap and wake up a worker to look at it.
+
+    Args:
+      time_to_run: When the entry is due.
+      task_id: The task to run, or a signal for the worker.
+      task_version: The version of the task the entry runs.
+    """
+    with self.condition:
+      heappush(self.heap,
+               (time_to_run, next(self.sequence), task_id, task_version))
+      self.condition.notify()
+
+  def _next_task(self) -> Optional[Tuple]:
+    """Wait until a task is due and take it off the queue.
+
+    Returns:
+      The task id, entry version, generation, function, args and kwargs of the
+      task to run, or None if the worker should stop.
+    """
+    with self.condition:
+      while True:
+        if not self.heap:
+          self.condition.wait()
+          continue
+
+        time_to_run, _, task_id, task_version = self.heap[0]
+        if task_id == Signal.STOP:
+          # Stop signals sort last, so every task before them has been run
+          heappop(self.heap)
+          return None
+
+        time_to_wait = time_to_run - monotonic()
+        if time_to_wait > 0:
+          self.condition.wait(time_to_wait)
+          continue
+        heappop(self.heap)
+
+        with self._task_lock(task_id):
+          # If there is a newer version of the task, skip this one
+          if not self._owns_task(task_id, task_version):
+            logger.info('Task cancelled')
+            continue
+
+          # The task may have been pushed back since the entry was queued
+          time_to_run, _, fn, args, kwargs = self.pending[task_id]
+          if time_to_run > monotonic():
+            heappush(self.heap, (time_to_run, next(self.sequence), task_id,
+                                 task_version))
+            continue
+
+          # Wait for the current run to finish, it queues the task again
+          if task_id in self.running:
+            continue
+
+          del self.pending[task_id]
+          self.running.add(task_id)
+          return (task_id, task_version, self.generations[task_id], fn, args,
+                  kwargs)
+
+  def _task_lock(self, task_id) -> Lock:
+    """
+    Args:
+      task_id: The task to lock.
+
+    Returns:
+      The lock guarding the task's bookkeeping.
+    """
+    return self.task_locks[hash(task_id) % NUM_TASK_LOCKS]
+
+  def _wake_waiters(self, task_id: str):
+    """Release everyone waiting on a task.
+
+    The caller must hold the lock for the task.
+
+    Args:
+      task_id: The task that is done.
+    """
+    waiter = self.waiters.pop(task_id, None)
+    if waiter is not None:
+      waiter.set()
+
+  def _is_current(self, task_id: str, generation: int) -> bool:
+    """Check whether a run is for the latest submission of its task.
+
+    The caller must hold the lock for the task.
+
+    Args:
+      task_id: The task being run.
+      generation: The generation the run started with.
+
+    Returns:
+      Whether the task has not been submitted again since the run started.
+    """
+    return self.generations.get(task_id) == generation
+
+  def _owns_task(self, task_id: str, task_version: int) -> bool:
+    """Check whether a queue entry is the one that should run a task.
+
+    The caller must hold the lock for the task.
+
+    Args:
+      task_id: The task to check.
+      task_version: The version the entry was queued with.
+
+    Returns:
+      Whether the task is still waiting to run, and this entry will run it.
+    """
+    pending = self.pending.get(task_id)
+    return pending is not None and pending[1] == task_version
+
   def start(self):
     """Start the background worker threads."""
     if self.run_state == RunState.RUNNING:
       raise ValueError('Task queue already started.')
 
+    self.stopping.clear()
     for i in range(self.num_workers):
       thread = Thread(target=self.run_worker, args=(i,))
       thread.start()
@@ -120,14 +256,20 @@ class TaskQueue:
     """
     if self.run_state == RunState.STOPPED:
       raise ValueError('Task queue already stopped.')
+    self.stopping.set()
 
-    # Gather the queue mutex to clear it and send stop signals.
+    # Clear the queue if we are not waiting for the remaining tasks.
     if not finish_ongoing_tasks:
-      with self.queue.mutex:
-        self.queue.clear()
+      with self.condition:
+        self.heap.clear()
+        self.pending.clear()
+        self.generations.clear()
+      for task_id in list(self.waiters):
+        with self._task_lock(task_id):
+          self._wake_waiters(task_id)
 
     for i in range(self.num_workers):
-      self.queue.put((float('inf'), Signal.STOP))
+      self._push(float('inf'), Signal.STOP)
 
     logger.info('Waiting for workers to stop.')
     for thread in self.threads:
@@ -151,16 +293,24 @@ class TaskQueue:
       raise ValueError('Start the task queue before submitting tasks.')
 
     logger.info('Received task %s %s', task_id, delay)
-    time_to_run = time() + delay
+    time_to_run = monotonic() + delay
     args = args or ()
     kwargs = kwargs or {}
 
-    with self.task_locks[task_id]:
-      self.tasks[task_id] += 1
-      task_version = self.tasks[task_id]
+    task_version = next(self.versions)
+    with self._task_lock(task_id):
+      self.generations[task_id] = task_version
 
-    self.queue.put((time_to_run, (task_id, task_version, fn, args, kwargs)))
-    logger.info('Task queue size %s', self.queue.qsize())
+      # If the task is already waiting and will not run any earlier with this
+      # submission, push its deadline back instead of queuing it again
+      pending = self.pending.get(task_id)
+      if pending is not None and pending[0] <= time_to_run:
+        self.pending[task_id] = (time_to_run, pending[1], fn, args, kwargs)
+        logger.info('Task postponed %s', task_id)
+        return
+      self.pending[task_id] = (time_to_run, task_version, fn, args, kwargs)
+
+    self._push(time_to_run, task_id, task_version)
 
   def cancel_task(self, task_id: str):
     """Cancel a submitted task.
@@ -169,5 +319,52 @@ class TaskQueue:
       task_id: The task to cancel.
     """
     logger.info('Cancel task %s', task_id)
-    with self.task_locks[task_id]:
-      self.tasks[task_id] += 1
+    with self._task_lock(task_id):
+      self.pending.pop(task_id, None)
+      if task_id in self.running:
+        # Move the generation on, so a failing run is not retried
+        self.generations[task_id] = next(self.versions)
+      else:
+        self.generations.pop(task_id, None)
+        self._wake_waiters(task_id)
+
+  def wait_for_task(self, task_id: str, timeout: float = None) -> bool:
+    """Wait until a task has finished running its latest submission.
+
+    Returns right away if the task is neither waiting nor running. A task that
+    fails is retried, and is only done once a run succeeds.
+
+    Args:
+      task_id: The task to wait for.
+      timeout: How long to wait for, or None to wait until the task is done.
+
+    Returns:
+      Whether the task is done.
+    """
+    with self._task_lock(task_id):
+      if task_id not in self.pending and task_id not in self.running:
+        return True
+      waiter = self.waiters.get(task_id)
+      if waiter is None:
+        waiter = self.waiters[task_id] = Event()
+    return waiter.wait(timeout)
+
+  def expedite_task(self, task_id: str):
+    """Run a waiting task now, instead of at its deadline.
+
+    Does nothing if the task is not waiting to run.
+
+    Args:
+      task_id: The task to run.
+    """
+    time_to_run = monotonic()
+    task_version = next(self.versions)
+    with self._task_lock(task_id):
+      pending = self.pending.get(task_id)
+      if pending is None or pending[0] <= time_to_run:
+        return
+      _, _, fn, args, kwargs = pending
+      self.pending[task_id] = (time_to_run, task_version, fn, args, kwargs)
+
+    logger.info('Expedite task %s', task_id)
+    self._push(time_to_run, task_id, task_version)